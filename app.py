@@ -4,10 +4,14 @@ Handles Datastore model and JSON calls from the browser.
 Also includes environment information call.
 """
 
+import collections
 import datetime
+import functools
 import json
 import logging
 import os
+import threading
+import time
 
 import webapp2
 
@@ -19,6 +23,103 @@ from google.appengine.ext import ndb
 # How long items will be kept in memcache, in seconds.
 MEMCACHE_TIMEOUT = 60
 
+# How long a saved script's cache slot stays blocked, in seconds. Must cover
+# the time between a concurrent load reading the entity and filling the slot.
+INVALIDATION_TIMEOUT = 5
+
+# Placeholder occupying a script cache slot after save, read as a miss.
+_INVALIDATED_ENTRY = ''
+
+# How many example scripts are kept in instance memory, and for how long, in
+# seconds. The timeout bounds how long other instances may serve an example
+# after it was saved.
+LOCAL_CACHE_SIZE = 256
+LOCAL_CACHE_TIMEOUT = 10
+
+
+def _FormatDateTime(value):
+  """Formats naive UTC datetime as fixed width YYYY-MM-DDTHH:MM:SSZ.
+
+  Fractional seconds are dropped, isoformat() would only include them when
+  non-zero and the browser sorts by these strings.
+  """
+  return value.replace(microsecond=0).isoformat() + 'Z'
+
+
+def _JsonDefault(obj):
+  """Serializes types unknown to the JSON encoder."""
+  if isinstance(obj, datetime.datetime):
+    return _FormatDateTime(obj)
+  raise TypeError('%r is not JSON serializable' % obj)
+
+
+# Shared compact encoder; json.dumps() builds a new encoder per call whenever
+# non-default options are given.
+_JSON_ENCODER = json.JSONEncoder(separators=(',', ':'), default=_JsonDefault)
+
+# Constant responses, serialized once.
+_EMPTY_LIST_JSON = '[]'
+_COMMENT_ID_ZERO_JSON = '{"commentId":"0"}'
+
+# Endings completing cached script JSON with the per-user flags, indexed by
+# (admin, update).
+_SCRIPT_FLAGS_JSON = dict(
+    ((admin, update), ',"admin":%s,"update":%s}' % (
+        _JSON_ENCODER.encode(admin), _JSON_ENCODER.encode(update)))
+    for admin in (False, True) for update in (False, True))
+
+
+class _LocalCache(object):
+  """Thread-safe LRU cache kept in instance memory in front of memcache."""
+
+  def __init__(self, max_size, timeout):
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+    self._max_size = max_size
+    self._timeout = timeout
+
+  def get(self, key):
+    """Returns cached value, or None if missing or expired."""
+    with self._lock:
+      item = self._entries.pop(key, None)
+      if item is None or item[0] < time.time():
+        return None
+      # Re-insert to mark as most recently used.
+      self._entries[key] = item
+      return item[1]
+
+  def set(self, key, value):
+    """Stores value, evicting the least recently used one if full."""
+    with self._lock:
+      self._entries.pop(key, None)
+      self._entries[key] = (time.time() + self._timeout, value)
+      if len(self._entries) > self._max_size:
+        self._entries.popitem(last=False)
+
+  def delete(self, key):
+    """Removes value if present."""
+    with self._lock:
+      self._entries.pop(key, None)
+
+
+# QScript.AsCacheEntry() tuples of example scripts by script id. Examples are
+# read often and rarely saved; other scripts are only cached in memcache, as
+# saves on one instance do not reach the memory of others.
+_SCRIPT_CACHE = _LocalCache(LOCAL_CACHE_SIZE, LOCAL_CACHE_TIMEOUT)
+
+
+def _GetUserContext(request):
+  """Returns (user, is_admin) for the current request.
+
+  The users API is queried once per request and the result is kept in the
+  request registry for subsequent calls.
+  """
+  ctx = request.registry.get('user_context')
+  if ctx is None:
+    ctx = (users.get_current_user(), users.is_current_user_admin())
+    request.registry['user_context'] = ctx
+  return ctx
+
 
 def _GetNickname(user):
   if user:
@@ -26,21 +127,84 @@ def _GetNickname(user):
   return 'anonymous'
 
 
+def _GetEmail(user):
+  if user:
+    return user.email()
+  return ''
+
+
+def _PackFields(fields):
+  """Joins string fields into a single memcache value.
+
+  Plain strings are stored by memcache as they are, other values would be
+  pickled. Fields must not contain newlines, which compact JSON never does.
+  """
+  return '\n'.join(fields)
+
+
+def _UnpackFields(packed, count):
+  """Splits memcache value created by _PackFields() into count fields."""
+  return packed.split('\n', count - 1)
+
+
+# Script overwrite policy, indexed by E << 2 | A << 1 | D:
+# Example Admin Different_user New_qscript
+# E  A  D  N
+# 0  0  0  0 (user can overwrite own scripts)
+# 0  0  1  1
+# 0  1  0  0 (admin can overwrite own scripts)
+# 0  1  1  1
+# 1  0  0  1 (should never happen)
+# 1  0  1  1
+# 1  1  0  0 (only admins can overwrite
+# 1  1  1  0  examples)
+# Entries are the negation of N, i.e. whether the script may be updated.
+_UPDATE_TABLE = (True, False, True, False, False, False, True, True)
+
+
+def _CanUpdate(author, example, user, is_admin):
+  """Returns True if user may overwrite the script in place."""
+  return _UPDATE_TABLE[bool(example) << 2 | is_admin << 1 | (author != user)]
+
+
 class RestHandler(webapp2.RequestHandler):
   """Handler helper for REST requests/responses."""
 
+  def read_params(self):
+    """Deserializes JSON request body.
+
+    Reads the body stream directly, request.body would first copy it into
+    a seekable buffer.
+
+    Returns:
+      Object sent by the browser.
+    """
+    return json.load(self.request.body_file)
+
   def respond(self, msg):
     """Serializes object to JSON and sends as HTTP response.
 
     Args:
       msg: Object to be serialized and sent.
     """
-    self.response.headers['Content-Type'] = 'application/javascript'
-    self.response.out.write(json.dumps(msg))
+    self.respond_raw(_JSON_ENCODER.encode(msg))
+
+  def respond_raw(self, payload):
+    """Sends already serialized JSON as HTTP response.
+
+    Args:
+      payload: JSON string to be sent.
+    """
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.out.write(payload)
 
 
 class QScript(ndb.Model):
   """Datastore model class for QScript entity."""
+  # Memcache is managed by the handlers, keep only the in-context cache.
+  _use_cache = True
+  _use_memcache = False
+
   author = ndb.UserProperty()
   content = ndb.TextProperty()
   created = ndb.DateTimeProperty(auto_now_add=True)
@@ -50,44 +214,68 @@ class QScript(ndb.Model):
 
   @staticmethod
   def CacheKey(qid):
-    """Returns string key used in memcache operations."""
-    return str(qid) + '|qscript'
+    """Returns string key used in memcache operations.
 
-  def AsDict(self):
-    """Converts complete object state to dict.
+    The suffix is versioned with the cached value format, app versions
+    sharing memcache must not read each other's entries.
+    """
+    return '%d|qscript2' % qid
+
+  def AsCacheEntry(self):
+    """Converts complete object state to a memcache entry.
 
     Returns:
-      Dict contains names of properties mapped to values suitable for display
-      on client side in browser.
+      Tuple of strings: example flag ('1' or '0'), author email and JSON
+      object with all properties. The JSON lacks the per-user 'admin' and
+      'update' flags, which are added by _ScriptJson().
     """
-    update = True
-    if ((self.example and not users.is_current_user_admin()) or
-        (not self.example and self.author != users.get_current_user())):
-      update = False
-    return {
+    payload = _JSON_ENCODER.encode({
         'id': str(self.key.id()),
         'author': _GetNickname(self.author),
         'content': self.content,
-        'created': self.created.strftime('%Y-%m-%dT%H:%M:%SZ'),
-        'modified': self.modified.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'created': self.created,
+        'modified': self.modified,
         'name': self.name,
-        'example': self.example,
-        'admin': users.is_current_user_admin(),
-        'update': update
-    }
+        'example': self.example
+    })
+    return ('1' if self.example else '0', _GetEmail(self.author), payload)
 
-  def PartAsDict(self):
-    """Returns partial object state as dict."""
-    return {
-        'id': str(self.key.id()),
-        'created': self.created.strftime('%Y-%m-%dT%H:%M:%SZ'),
-        'modified': self.modified.strftime('%Y-%m-%dT%H:%M:%SZ'),
-        'name': self.name
-    }
+  def PartAsJson(self):
+    """Returns partial object state as JSON object.
+
+    Formatted directly, without building an intermediate dict, as it is
+    called for every script in a list.
+    """
+    return '{"id":"%d","created":"%s","modified":"%s","name":%s}' % (
+        self.key.id(), _FormatDateTime(self.created),
+        _FormatDateTime(self.modified), _JSON_ENCODER.encode(self.name))
+
+
+# Builds QScript keys from numeric ids.
+_QScriptKey = functools.partial(ndb.Key, QScript)
+
+
+def _ScriptJson(entry, user, is_admin):
+  """Completes QScript.AsCacheEntry() JSON for the current user.
+
+  Args:
+    entry: Tuple returned by QScript.AsCacheEntry().
+    user: Current user, or None if not logged in.
+    is_admin: True if current user is an admin.
+
+  Returns:
+    Complete JSON object to be sent to the browser.
+  """
+  example, author, payload = entry
+  update = _CanUpdate(author, example == '1', _GetEmail(user), is_admin)
+  return payload[:-1] + _SCRIPT_FLAGS_JSON[is_admin, update]
 
 
 class Comment(ndb.Model):
   """Datastore model class for Comment entity."""
+  _use_cache = True
+  _use_memcache = False
+
   author = ndb.UserProperty()
   content = ndb.TextProperty()
   created = ndb.DateTimeProperty(auto_now_add=True)
@@ -95,8 +283,11 @@ class Comment(ndb.Model):
 
   @staticmethod
   def CacheKey(qid):
-    """Returns string key used in memcache operations."""
-    return str(qid) + '|comments'
+    """Returns string key used in memcache operations.
+
+    Versioned like QScript.CacheKey().
+    """
+    return '%d|comments2' % qid
 
   def AsDict(self):
     """Returns complete object state as dict."""
@@ -104,7 +295,7 @@ class Comment(ndb.Model):
         'id': str(self.key.id()),
         'author': _GetNickname(self.author),
         'content': self.content,
-        'created': self.created.strftime('%Y-%m-%dT%H:%M:%SZ')
+        'created': self.created
     }
 
 
@@ -112,7 +303,7 @@ class GetUserInfoCtrl(RestHandler):
   """Load user information data for JS app."""
 
   def get(self):  # pylint: disable=g-bad-name
-    user = users.get_current_user()
+    user, _ = _GetUserContext(self.request)
     if not user:
       self.respond({'nickname': '',
                     'url': users.create_login_url(self.request.referer)})
@@ -131,36 +322,33 @@ class SaveScriptCtrl(RestHandler):
     If id refers to non-existent script creates a new entity, otherwise
     updates existing one.
     """
-    params = json.loads(self.request.body)
-    qid = long(params['id'])
+    params = self.read_params()
+    qid = int(params['id'])
     qscript = None
-    if qid is None or qid != 0:
-      key = ndb.Key(QScript, qid)
+    if qid:
+      key = _QScriptKey(qid)
       qscript = key.get()
-    user = users.get_current_user()
-    # Logic here:
-    # Example Admin Different_user New_qscript
-    # E  A  D  N
-    # 0  0  0  0 (user can overwrite own scripts)
-    # 0  0  1  1
-    # 0  1  0  0 (admin can overwrite own scripts)
-    # 0  1  1  1
-    # 1  0  0  1 (should never happen)
-    # 1  0  1  1
-    # 1  1  0  0 (only admins can overwrite
-    # 1  1  1  0  examples)
+    user, is_admin = _GetUserContext(self.request)
+    # See _UPDATE_TABLE for when a new script is created instead.
     if (not qscript or
-        (qscript.example and not users.is_current_user_admin()) or
-        (not qscript.example and qscript.author != user)):
+        not _CanUpdate(qscript.author, qscript.example, user, is_admin)):
       qscript = QScript()
       qscript.author = user
       qscript.example = False
     qscript.content = params['content']
     qscript.name = params['name']
+    # Leave repopulating the cache to the next load instead of evicting other
+    # entries on every save. After the write the slot is blocked with a
+    # placeholder rather than emptied, so a concurrent load that read the old
+    # entity fails its add() and cannot cache the old version. Instance
+    # memory goes first, as it is filled from memcache.
+    if qscript.key:
+      _SCRIPT_CACHE.delete(qscript.key.id())
+      memcache.delete(QScript.CacheKey(qscript.key.id()))
     qscript.put()
-    if not memcache.set(QScript.CacheKey(qscript.key.id()), qscript,
-                        time=MEMCACHE_TIMEOUT):
-      logging.error('Memcache set failed!')
+    _SCRIPT_CACHE.delete(qscript.key.id())
+    memcache.set(QScript.CacheKey(qscript.key.id()), _INVALIDATED_ENTRY,
+                 time=INVALIDATION_TIMEOUT)
     self.respond({'qscriptId': str(qscript.key.id())})
 
 
@@ -174,19 +362,32 @@ class LoadScriptCtrl(RestHandler):
     If script exists returns complete script record, otherwise
     returns empty new script template.
     """
-    params = json.loads(self.request.body)
-    qid = long(params['id'])
-    qscript = None
+    params = self.read_params()
+    qid = int(params['id'])
+    entry = None
     if qid:
-      qscript = memcache.get(QScript.CacheKey(qid))
-      if not qscript:
-        qscript = ndb.Key(QScript, qid).get()
-        if (qscript and
-            not memcache.set(QScript.CacheKey(qid), qscript,
-                             time=MEMCACHE_TIMEOUT)):
-          logging.error('Memcache set failed!')
-    if qscript:
-      self.respond(qscript.AsDict())
+      entry = _SCRIPT_CACHE.get(qid)
+      if not entry:
+        cacheable = False
+        packed = memcache.get(QScript.CacheKey(qid))
+        if packed:
+          entry = _UnpackFields(packed, 3)
+          cacheable = True
+        else:
+          qscript = _QScriptKey(qid).get()
+          if qscript:
+            entry = qscript.AsCacheEntry()
+            # Only fill an empty slot, never overwrite what a concurrent
+            # request has put there in the meantime. The slot is blocked
+            # right after a save, the entity read here may then be stale.
+            cacheable = memcache.add(QScript.CacheKey(qid), _PackFields(entry),
+                                     time=MEMCACHE_TIMEOUT)
+        # Only examples are kept in instance memory, see _SCRIPT_CACHE.
+        if cacheable and entry[0] == '1':
+          _SCRIPT_CACHE.set(qid, entry)
+    user, is_admin = _GetUserContext(self.request)
+    if entry:
+      self.respond_raw(_ScriptJson(entry, user, is_admin))
     else:
       self.respond({
           'id': '0',
@@ -194,8 +395,8 @@ class LoadScriptCtrl(RestHandler):
           'content': '',
           'created': '',
           'modified': '',
-          'author': _GetNickname(users.get_current_user()),
-          'admin': users.is_current_user_admin(),
+          'author': _GetNickname(user),
+          'admin': is_admin,
           'update': False,
           'example': False
       })
@@ -210,13 +411,13 @@ class AddCommentCtrl(RestHandler):
     Expects JSON dict with script id and comment content.
     Returns comment id of newly added comment, zero if user is not logged in.
     """
-    params = json.loads(self.request.body)
-    user = users.get_current_user()
+    params = self.read_params()
+    user, _ = _GetUserContext(self.request)
     if not user:
-      self.respond({'commentId': '0'})
+      self.respond_raw(_COMMENT_ID_ZERO_JSON)
       return
-    qid = long(params['qscriptId'])
-    key = ndb.Key(QScript, qid)
+    qid = int(params['qscriptId'])
+    key = _QScriptKey(qid)
     memcache.delete(Comment.CacheKey(qid))
     comment = Comment()
     comment.author = user
@@ -236,16 +437,16 @@ class DeleteCommentCtrl(RestHandler):
     Responds with comment id zero if removal was successful,
     original comment id otherwise.
     """
-    params = json.loads(self.request.body)
-    cid = long(params['id'])
-    user = users.get_current_user()
+    params = self.read_params()
+    cid = int(params['id'])
+    user, is_admin = _GetUserContext(self.request)
     key = ndb.Key(Comment, cid)
     comment = key.get()
     # Only allow admins and comment author to remove.
-    if comment and (comment.author == user or users.is_current_user_admin()):
+    if comment and (comment.author == user or is_admin):
       memcache.delete(Comment.CacheKey(comment.qscript.id()))
       key.delete()
-      self.respond({'commentId': '0'})
+      self.respond_raw(_COMMENT_ID_ZERO_JSON)
     else:
       self.respond({'commentId': str(comment.key.id())})
 
@@ -260,27 +461,40 @@ class LoadCommentsCtrl(RestHandler):
     Responds with array of comments data with comment ids removed for
     non-admins and non-author of a comment.
     """
-    params = json.loads(self.request.body)
-    qid = long(params['qscriptId'])
-    if qid is None or qid == 0:
-      self.respond([])
+    params = self.read_params()
+    qid = int(params['qscriptId'])
+    if not qid:
+      self.respond_raw(_EMPTY_LIST_JSON)
+      return
+    # Comments are cached already serialized, once with all ids included and
+    # once with all ids removed, the views of admins and anonymous users.
+    response = None
+    packed = memcache.get(Comment.CacheKey(qid))
+    if packed is None:
+      qskey = _QScriptKey(qid)
+      comments = Comment.query(Comment.qscript == qskey).fetch()
+      response = [cmt.AsDict() for cmt in comments]
+      cached = (_JSON_ENCODER.encode(response),
+                _JSON_ENCODER.encode([dict(cmt, id='') for cmt in response]))
+      if not memcache.set(Comment.CacheKey(qid), _PackFields(cached),
+                          time=MEMCACHE_TIMEOUT):
+        logging.error('Memcache set failed!')
+    else:
+      cached = _UnpackFields(packed, 2)
+    payload, anonymous_payload = cached
+    user, admin = _GetUserContext(self.request)
+    if admin:
+      self.respond_raw(payload)
+      return
+    if not user:
+      self.respond_raw(anonymous_payload)
       return
-    response = memcache.get(Comment.CacheKey(qid))
-    if not response:
-      qskey = ndb.Key(QScript, qid)
-      comments = Comment.query(Comment.qscript == qskey)
-      if comments:
-        response = [cmt.AsDict() for cmt in comments]
-        if not memcache.set(Comment.CacheKey(qid), response,
-                            time=MEMCACHE_TIMEOUT):
-          logging.error('Memcache set failed!')
-      else:
-        response = []
-    nickname = _GetNickname(users.get_current_user())
-    admin = users.is_current_user_admin()
+    if response is None:
+      response = json.loads(payload)
+    nickname = _GetNickname(user)
     # Only allow admins and comment author to see comment id.
     for cmt in response:
-      if cmt['author'] != nickname and not admin:
+      if cmt['author'] != nickname:
         cmt['id'] = ''
     self.respond(response)
 
@@ -294,13 +508,13 @@ class LoadMyScriptsCtrl(RestHandler):
     Returns array of partial script data with script titles, created date,
     and modified date.
     """
-    user = users.get_current_user()
+    user, _ = _GetUserContext(self.request)
     if not user:
-      self.respond([])
+      self.respond_raw(_EMPTY_LIST_JSON)
       return
-    scripts = QScript.query(QScript.author == user)
-    scripts.fetch(projection=['created', 'modified', 'name'])
-    self.respond([qs.PartAsDict() for qs in scripts])
+    scripts = QScript.query(QScript.author == user).fetch(
+        projection=[QScript.created, QScript.modified, QScript.name])
+    self.respond_raw('[%s]' % ','.join([qs.PartAsJson() for qs in scripts]))
 
 
 class RemoveOldScriptsCtrl(RestHandler):
@@ -310,19 +524,22 @@ class RemoveOldScriptsCtrl(RestHandler):
     """Handles request to clean up scripts.
 
     Removes all anonymous scripts not touched in last 90 days.
+    Responds with array of removed script ids.
     """
-    user = users.get_current_user()
-    if not user or not users.is_current_user_admin():
-      self.respond([])
+    user, is_admin = _GetUserContext(self.request)
+    if not user or not is_admin:
+      self.respond_raw(_EMPTY_LIST_JSON)
       return
-    cutoff = datetime.today() - datetime.timedelta(days=90)
-    scripts = QScript.query(QScript.author is None, QScript.modified < cutoff)
-    scripts.fetch(projection=['created', 'modified', 'name'])
-    for qs in scripts:
-      memcache.delete(QScript.CacheKey(qs.key.id()))
-      memcache.delete(Comment.CacheKey(qs.key.id()))
-      qs.key.delete()
-    self.respond([qs.PartAsDict() for qs in scripts])
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=90)
+    keys = QScript.query(
+        QScript.author == None,  # pylint: disable=g-equals-none
+        QScript.modified < cutoff).fetch(keys_only=True)
+    for key in keys:
+      _SCRIPT_CACHE.delete(key.id())
+    memcache.delete_multi([QScript.CacheKey(key.id()) for key in keys] +
+                          [Comment.CacheKey(key.id()) for key in keys])
+    ndb.delete_multi(keys)
+    self.respond([str(key.id()) for key in keys])
 
 
 app = webapp2.WSGIApplication([